@@ -1,13 +1,25 @@
 import ffmpeg
+import asyncio
+import os
 from pathlib import Path
 import shutil
 import logging
 import re
+from functools import lru_cache
 from unidecode import unidecode
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 
+_SAFE_RE = re.compile(r"[^\w]+")
+
+
+@lru_cache(maxsize=1024)
+def _safe_stem(stem: str) -> str:
+    # Очистка имени: ASCII + нижний регистр + только буквы/цифры/подчёркивания
+    return _SAFE_RE.sub("_", unidecode(stem).lower()).strip("_")
+
+
 class AudioConverter:
     def to_wav(self, input_path: str, output_path: str = None) -> Path:
         return self._convert(input_path, output_path, "wav")
@@ -18,6 +30,40 @@ class AudioConverter:
     def to_flac(self, input_path: str, output_path: str = None) -> Path:
         return self._convert(input_path, output_path, "flac")
 
+    def to_wav_batch(self, input_paths: list) -> list:
+        """Converts several files to 32-bit WAV concurrently, one ffmpeg process per core"""
+        return asyncio.run(self._convert_batch(input_paths, "wav"))
+
+    @staticmethod
+    async def _convert_batch(input_paths: list, target_format: str) -> list:
+        semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+
+        async def _run_one(input_path) -> Path:
+            input_path = Path(input_path).resolve()
+            if not input_path.exists():
+                raise FileNotFoundError(f"[Converter] File not found: {input_path}")
+            output_path = input_path.with_suffix(f".{target_format}")
+
+            codec_args = ["-c:a", "pcm_f32le"] if target_format == "wav" else []
+            async with semaphore:
+                logger.info(f"[Converter] Converting {input_path.name} → {output_path.name}")
+                proc = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-y", "-i", str(input_path), *codec_args,
+                    "-map_metadata", "0", str(output_path),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await proc.communicate()
+
+            if proc.returncode != 0:
+                logger.error(f"[Converter] Failed to convert {input_path.name} to {target_format}: {stderr.decode(errors='ignore')}")
+                raise RuntimeError(f"[Converter] ffmpeg exited with code {proc.returncode} on {input_path.name}")
+
+            logger.info(f"[Converter] Saved: {output_path}")
+            return output_path
+
+        return list(await asyncio.gather(*[_run_one(p) for p in input_paths]))
+
     @staticmethod
     def _convert(input_path: str, output_path: str, target_format: str) -> Path:
         input_path = Path(input_path).resolve()
@@ -48,11 +94,7 @@ class AudioConverter:
     @staticmethod
     def convert_name(input_path: str) -> Path:
         original_path = Path(input_path).resolve()
-        stem = Path(original_path).stem
-
-        # Очистка имени: ASCII + нижний регистр + только буквы/цифры/подчёркивания
-        safe_stem = unidecode(stem).lower()
-        safe_stem = re.sub(r"[^\w]+", "_", safe_stem).strip("_")
+        safe_stem = _safe_stem(original_path.stem)
 
         safe_path = original_path.with_name(f"{safe_stem}{original_path.suffix}")
 
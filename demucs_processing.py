@@ -1,21 +1,129 @@
 # Demucs is used to divide vocals and instruments
 
-import demucs.separate
+import demucs
+from demucs.apply import BagOfModels
+from demucs.audio import convert_audio
+from demucs.htdemucs import HTDemucs
+from demucs.pretrained import get_model
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from toolbox.amp import resolve_amp_dtype
 import platform
-import shlex
-import shutil
+import io
 import logging
+import os
+import random
+import threading
 from pathlib import Path
 import torchaudio
 import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 
 
+def _resolve_device(device="auto", gpu_index: int = 0) -> str:
+    if device == "auto":
+        return f"cuda:{gpu_index}" if torch.cuda.is_available() else "cpu"
+    return f"cuda:{gpu_index}" if device == "cuda" else "cpu"
+
+
+TRACE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache/demucs_traced")
+
+
+class _TracedForward:
+    """
+    Подменяет forward модели Demucs трассированным TorchScript-графом.
+    Трасса валидна только для той формы входа, на которой снималась,
+    поэтому остальные формы (например, последний неполный чанк) идут через eager.
+    Трассировка идёт в фоновом потоке: пока граф не готов, forward работает в eager,
+    а запрос на обработку не ждёт trace + optimize_for_inference.
+    Каждый замороженный граф держит свою копию весов, поэтому хранятся
+    только MAX_TRACES последних форм. Трассировка и прогоны separate()
+    берут общий lock busy, чтобы их пики памяти на GPU не складывались
+    """
+
+    MAX_TRACES = 4
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="demucs-trace")
+    busy = threading.Lock()
+
+    def __init__(self, model, cache_prefix):
+        self.eager = model.forward
+        self.model = model
+        self.cache_prefix = cache_prefix
+        self.traces = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def trace(self, length, device, batch=1):
+        """Ставит трассировку формы [batch, C, length] в очередь, если её ещё нет"""
+        key = ((batch, self.model.audio_channels, length), str(torch.device(device)))
+        with self._lock:
+            if key in self.traces:
+                self.traces.move_to_end(key)
+                return
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._executor.submit(self._trace, key, length, device, batch)
+
+    def _trace(self, key, length, device, batch):
+        try:
+            # Версии в имени: граф, снятый с другой сборки torch или demucs, не подхватывается
+            cache_path = os.path.join(
+                TRACE_CACHE_DIR,
+                f"{self.cache_prefix}-{batch}x{length}-{torch.device(device).type}"
+                f"-torch{torch.__version__}-demucs{demucs.__version__}.pt"
+            )
+            # Ждёт, пока separate() не закончит текущий прогон
+            with self.busy:
+                if os.path.exists(cache_path):
+                    traced = torch.jit.load(cache_path, map_location=device)
+                else:
+                    example = torch.zeros(batch, self.model.audio_channels, length, device=device)
+                    # Форма ещё не в self.traces, так что forward внутри трассировки уходит в eager
+                    with torch.no_grad():
+                        traced = torch.jit.trace(self.model, example, strict=False, check_trace=False)
+                    traced = torch.jit.optimize_for_inference(traced)
+                    del example
+                    os.makedirs(TRACE_CACHE_DIR, exist_ok=True)
+                    torch.jit.save(traced, cache_path)
+            with self._lock:
+                self.traces[key] = traced
+                while len(self.traces) > self.MAX_TRACES:
+                    self.traces.popitem(last=False)
+            logger.info(f"[Demucs] Traced {self.cache_prefix} for input {key[0]}")
+        except Exception as e:
+            logger.warning(f"[Demucs] TorchScript trace failed, using eager forward: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def __call__(self, mix):
+        traced = self.traces.get((tuple(mix.shape), str(mix.device)))
+        if traced is None:
+            return self.eager(mix)
+        return traced(mix)
+
+
+@lru_cache(maxsize=4)
+def _get_demucs(name, device):
+    """Загружает модель один раз на процесс; все DemucsProcessor делят одну копию на GPU"""
+    logger.info(f"[Demucs] Loading model {name} on {device}")
+    model = get_model(name=name).to(device).eval()
+
+    sub_models = model.models if isinstance(model, BagOfModels) else [model]
+    for index, sub_model in enumerate(sub_models):
+        sub_model.forward = _TracedForward(sub_model, cache_prefix=f"{name}-{index}")
+    return model
+
+
 class DemucsProcessor:
-    def __init__(self):
+    def __init__(self, model="htdemucs_ft", device="auto", gpu_index: int = 0, amp=True):
         current_os = platform.system().lower()
 
         if current_os == "windows":
@@ -33,13 +141,190 @@ class DemucsProcessor:
             except RuntimeError:
                 logger.warning("[Audio] 'sox_io' backend unavailable. Falling back to default.")
 
+        # Модель загружается один раз и переиспользуется между вызовами separate
+        self.device = _resolve_device(device, gpu_index)
+        # Autocast на GPU: BF16 на Ampere+, иначе FP16; amp может быть и torch.dtype
+        self.amp_dtype = resolve_amp_dtype(amp)
+        self._model_key = None
+        self._model = None
+        self._copy_streams = {}
+        self._last_run_key = None
+        self._load_model(model)
+
+    def _load_model(self, name, device=None):
+        """Модель на device (по умолчанию — устройство из __init__); копии на устройство кеширует _get_demucs"""
+        key = (name, device or self.device)
+        if key == self._model_key:
+            return self._model
+        self._model = _get_demucs(*key)
+        self._model_key = key
+        return self._model
+
+    def _trace(self, segment=None, batch=1, device=None):
+        """
+        Запрашивает (в фоне) трассировку всех подмоделей под полный чанк длиной segment секунд.
+        Без segment каждая подмодель берёт свой: у BagOfModels атрибута segment
+        нет, get_model записывает его в подмодели
+        """
+        sub_models = self._model.models if isinstance(self._model, BagOfModels) else [self._model]
+        for sub_model in sub_models:
+            length = int(sub_model.samplerate * (segment if segment is not None else sub_model.segment))
+            if hasattr(sub_model, "valid_length"):
+                length = sub_model.valid_length(length)
+            sub_model.forward.trace(length, device or self.device, batch)
+
+    def _release_cached_memory(self, run_key):
+        """
+        Отдаёт блоки кеширующего аллокатора, если форма прогона поменялась
+        (другая модель, сегмент или число сдвигов). При тех же параметрах
+        кеш переиспользуется, и платить за empty_cache не нужно
+        """
+        if self._last_run_key is not None and run_key != self._last_run_key and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
+            logger.info("[Demucs] Released cached GPU memory before switching parameters")
+        self._last_run_key = run_key
+
+    def _to_device(self, chunk, device_str):
+        """
+        Копирует чанк на GPU из pinned-памяти в отдельном CUDA-стриме: пока
+        модель считает текущий чанк, следующий уже едет на устройство
+        """
+        if not device_str.startswith("cuda"):
+            return chunk
+        device = torch.device(device_str)
+        if device_str not in self._copy_streams:
+            self._copy_streams[device_str] = torch.cuda.Stream(device=device)
+        copy_stream = self._copy_streams[device_str]
+
+        chunk = chunk.pin_memory()
+        with torch.cuda.stream(copy_stream):
+            chunk_gpu = chunk.to(device, non_blocking=True)
+        compute_stream = torch.cuda.current_stream(device)
+        compute_stream.wait_stream(copy_stream)
+        chunk_gpu.record_stream(compute_stream)
+        return chunk_gpu
+
+    @staticmethod
+    def _window(tensor, start, length, target):
+        """Как TensorChunk.padded: окно [start, start + length), расширенное до target контекстом или нулями"""
+        delta = target - length
+        start = start - delta // 2
+        end = start + target
+        correct_start = max(0, start)
+        correct_end = min(tensor.shape[-1], end)
+        return F.pad(tensor[..., correct_start:correct_end], (correct_start - start, end - correct_end))
+
+    def _apply_shifted(self, model, mix, shifts, overlap, segment, device):
+        """
+        apply_model(split=True, shifts=shifts), но по чанкам и с батчем сдвигов:
+        вход и результат остаются в памяти хоста, на устройстве живёт только
+        текущий чанк [shifts * B, C, L] — все сдвинутые копии одного окна идут
+        одним прогоном модели. Сдвиг, как и в demucs, случайный в пределах 0.5 с.
+        Для BagOfModels результаты подмоделей смешиваются с весами, как в apply_model
+        """
+        sub_models = model.models if isinstance(model, BagOfModels) else [model]
+        weights = model.weights if isinstance(model, BagOfModels) else [[1.] * len(model.sources)]
+
+        estimates = None
+        totals = [0.] * len(model.sources)
+        for sub_model, sub_weights in zip(sub_models, weights):
+            out = self._apply_chunked(sub_model, mix, shifts, overlap, segment, device)
+            for k, weight in enumerate(sub_weights):
+                out[:, k] *= weight
+                totals[k] += weight
+            if estimates is None:
+                estimates = out
+            else:
+                estimates += out
+            del out
+
+        for k, total in enumerate(totals):
+            estimates[:, k] /= total
+        return estimates
+
+    def _apply_chunked(self, model, mix, shifts, overlap, segment, device):
+        """Одна подмодель: перекрывающиеся окна с треугольными весами, как в apply_model"""
+        batch, channels, length = mix.shape
+        if shifts:
+            max_shift = int(0.5 * model.samplerate)
+            # Копия i — это вход, задержанный на delays[i] отсчётов
+            delays = [max_shift - random.randint(0, max_shift) for _ in range(shifts)]
+        else:
+            max_shift, delays = 0, [0]
+        padded = F.pad(mix, (max_shift, max_shift))
+        shifted_length = length + max_shift
+
+        segment_length = int(model.samplerate * (segment if segment is not None else model.segment))
+        stride = int((1 - overlap) * segment_length)
+        offsets = list(range(0, shifted_length, stride))
+        weight = torch.cat([torch.arange(1, segment_length // 2 + 1),
+                            torch.arange(segment_length - segment_length // 2, 0, -1)]).float()
+        weight /= weight.max()
+
+        # Сумма весов известна заранее, поэтому каждый чанк сразу нормируется и
+        # складывается в результат, без буфера на всю длину для каждой копии
+        sum_weight = torch.zeros(shifted_length)
+        for offset in offsets:
+            n = min(segment_length, shifted_length - offset)
+            sum_weight[offset:offset + n] += weight[:n]
+
+        def load(offset):
+            n = min(segment_length, shifted_length - offset)
+            target = model.valid_length(n) if hasattr(model, "valid_length") else n
+            chunk = torch.cat([self._window(padded, offset + max_shift - d, n, target) for d in delays])
+            return self._to_device(chunk, device), n
+
+        out = torch.zeros(batch, len(model.sources), channels, length)
+        pending = load(offsets[0])
+        for index, offset in enumerate(offsets):
+            chunk, n = pending
+            res = model(chunk)
+            if index + 1 < len(offsets):
+                # Копия следующего чанка идёт, пока GPU считает текущий
+                pending = load(offsets[index + 1])
+            delta = res.shape[-1] - n
+            res = res[..., delta // 2:delta // 2 + n].float().cpu()
+            res *= weight[:n] / sum_weight[offset:offset + n]
+            del chunk
+
+            for i, delay in enumerate(delays):
+                # Время offset сдвинутой копии — это offset - delay исходного трека
+                start = offset - delay
+                lo, hi = max(0, start), min(length, start + n)
+                if hi > lo:
+                    out[..., lo:hi] += res[i * batch:(i + 1) * batch, ..., lo - start:hi - start]
+        return out / len(delays)
+
+    @staticmethod
+    def _max_segment(model):
+        """Максимально допустимая длина сегмента (сек) для трансформерных моделей"""
+        if isinstance(model, HTDemucs):
+            return float(model.segment)
+        if isinstance(model, BagOfModels):
+            return model.max_allowed_segment
+        return float("inf")
+
+    @staticmethod
+    def _source(input_path, name):
+        """(что передать в torchaudio.load, имя выходных файлов, подпись для логов)"""
+        # WAV из памяти (AudioRestorer.restore_to_bytes) декодируется без записи на диск
+        if isinstance(input_path, (bytes, bytearray, io.BytesIO)):
+            if name is None:
+                raise ValueError("[Demucs] name is required when input is an in-memory buffer")
+            source = input_path if isinstance(input_path, io.BytesIO) else io.BytesIO(input_path)
+            return source, name, f"<memory:{name}>"
+        source = Path(input_path).resolve()
+        return str(source), name or source.stem, str(source)
+
     def separate(self,
                  input_path,
                  output_dir,
                  model="htdemucs_ft",  # Изменено на htdemucs_ft как модель по умолчанию
                  device="auto",  # Автовыбор устройства
                  gpu_index: int = 0,
-                 mode="standard"):  # Новый параметр: режим обработки
+                 mode="standard",  # Новый параметр: режим обработки
+                 name=None):
         """
         Улучшенная версия с оптимизированными параметрами
 
@@ -48,69 +333,114 @@ class DemucsProcessor:
             - 'vintage': для старых записей (1940-60s)
             - 'high_quality': максимальное качество
             - 'fast': быстрая обработка
+        :param input_path: путь к файлу или WAV в памяти (bytes / io.BytesIO).
+            Список входов обрабатывается одним батчем: треки дополняются нулями
+            до самого длинного и после разделения обрезаются обратно
+        :param output_dir: папка для результатов (для списка входов — одна на все или список)
+        :param name: имя выходных файлов (для списка входов — список); обязательно для буферов
+        :return: (вокал, инструментал) или список таких пар для списка входов;
+            для входа, который не удалось прочитать, в списке стоит None
         """
-        input_path = Path(input_path).resolve()
-        output_dir = Path(output_dir).resolve()
-        output_dir.mkdir(parents=True, exist_ok=True)
+        batched = isinstance(input_path, list)
+        inputs = input_path if batched else [input_path]
+        names = (list(name) if batched else [name]) if name is not None else [None] * len(inputs)
+        output_dirs = output_dir if isinstance(output_dir, list) else [output_dir] * len(inputs)
 
-        # Автовыбор устройства
-        if device == "auto":
-            device_str = f"cuda:{gpu_index}" if torch.cuda.is_available() else "cpu"
-        else:
-            device_str = f"cuda:{gpu_index}" if device == "cuda" else "cpu"
+        output_dirs = [Path(d).resolve() for d in output_dirs]
+        for d in set(output_dirs):
+            d.mkdir(parents=True, exist_ok=True)
+
+        device_str = _resolve_device(device, gpu_index)
 
         # Параметры для разных режимов
         params_config = {
-            'standard': {'shifts': 1, 'overlap': 0.25, 'jobs': 0},
-            'vintage': {'shifts': 7, 'overlap': 0.65, 'jobs': 2, 'segment': 12},
-            'high_quality': {'shifts': 10, 'overlap': 0.75, 'jobs': 1},
-            'fast': {'shifts': 0, 'overlap': 0.1, 'jobs': 4}
+            'standard': {'shifts': 1, 'overlap': 0.25},
+            'vintage': {'shifts': 7, 'overlap': 0.65, 'segment': 12},
+            'high_quality': {'shifts': 10, 'overlap': 0.75},
+            'fast': {'shifts': 0, 'overlap': 0.1}
         }
 
         params = params_config[mode]
 
-        logger.info(f"[Demucs] Processing file: {input_path} | Device: {device_str} | Mode: {mode}")
+        demucs_model = self._load_model(model, device_str)
+
+        # Каждый вход декодируется отдельно: битый файл выпадает из батча
+        # (его результат — None), остальные треки разделяются как обычно
+        wavs, refs, ok = [], [], []
+        for index, item in enumerate(inputs):
+            try:
+                source, names[index], label = self._source(item, names[index])
+                wav, sr = torchaudio.load(source)
+                wav = convert_audio(wav, sr, demucs_model.samplerate, demucs_model.audio_channels)
+            except Exception as e:
+                if not batched:
+                    logger.exception("Error while separating audio with Demucs")
+                    raise RuntimeError(f"[Demucs] Separation failed: {e}")
+                logger.error(f"[Demucs] Skipping input {index} of the batch: {e}")
+                continue
+            logger.info(f"[Demucs] Processing file: {label} | Device: {device_str} | Mode: {mode}")
+
+            # Нормализация как в demucs.separate, для каждого трека своя
+            ref = wav.mean(0)
+            wavs.append((wav - ref.mean()) / ref.std())
+            refs.append((ref.mean(), ref.std()))
+            ok.append(index)
+        if not ok:
+            return [None] * len(inputs)
+        lengths = [wav.shape[-1] for wav in wavs]
 
-        # Формируем аргументы с новыми параметрами
-        args = shlex.split(
-            f'--two-stems vocals '
-            f'-n {model} '
-            f'--float32 '
-            f'--device {device_str} '
-            f'--shifts {params["shifts"]} '
-            f'--overlap {params["overlap"]} '
-            f'--jobs {params["jobs"]} '
-            f'"{input_path}"'
-        )
+        segment = params.get('segment')
+        if segment is not None:
+            segment = min(segment, self._max_segment(demucs_model))
+        self._release_cached_memory((model, device_str, segment, params["shifts"], params["overlap"]))
+        self._trace(segment, batch=len(ok) * max(1, params["shifts"]), device=device_str)
 
         try:
-            demucs.separate.main(args)
+            # [B, C, T_max]: короткие треки дополняются нулями по оси времени
+            mix = pad_sequence([wav.T for wav in wavs], batch_first=True).transpose(1, 2).contiguous()
+            del wavs
+
+            # mix и результат остаются на хосте: на GPU копируется только текущий чанк
+            apply_kwargs = dict(overlap=params["overlap"], segment=segment, device=device_str)
+            use_amp = self.amp_dtype is not None and device_str.startswith("cuda")
+            # Фоновая трассировка не идёт одновременно с прогоном
+            with _TracedForward.busy, torch.inference_mode():
+                try:
+                    with torch.autocast("cuda", dtype=self.amp_dtype or torch.float16, enabled=use_amp):
+                        sources = self._apply_shifted(demucs_model, mix, params["shifts"], **apply_kwargs)
+                except RuntimeError as e:
+                    # OOM в float32 только усугубится
+                    if not use_amp or isinstance(e, torch.cuda.OutOfMemoryError):
+                        raise
+                    logger.warning(f"[Demucs] {self.amp_dtype} autocast failed, retrying in float32: {e}")
+                    sources = self._apply_shifted(demucs_model, mix, params["shifts"], **apply_kwargs)
+            del mix
         except Exception as e:
             logger.exception("Error while separating audio with Demucs")
             raise RuntimeError(f"[Demucs] Separation failed: {e}")
 
-        # Остальная часть метода остается без изменений
-        stem_name = input_path.stem
-        base_dir = Path(f"separated/{model}/{stem_name}").resolve()
-
-        vocals_path = base_dir / "vocals.wav"
-        no_vocals_path = base_dir / "no_vocals.wav"
+        vocals_index = demucs_model.sources.index("vocals")
+        results = [None] * len(inputs)
+        for row, (index, length, (mean, std)) in enumerate(zip(ok, lengths, refs)):
+            item = sources[row, ..., :length].float() * std + mean
 
-        if not vocals_path.exists() or not no_vocals_path.exists():
-            logger.error("Expected output files not found.")
-            raise FileNotFoundError("Demucs output files missing.")
+            final_vocals = output_dirs[index] / f"{names[index]}-vocals.wav"
+            final_instr = output_dirs[index] / f"{names[index]}-instrumental.wav"
 
-        final_vocals = output_dir / f"{stem_name}-vocals.wav"
-        final_instr = output_dir / f"{stem_name}-instrumental.wav"
+            # --two-stems vocals: вокал и сумма остальных источников
+            vocals = item[vocals_index]
+            no_vocals = item.sum(0) - vocals
 
-        shutil.copy(vocals_path, final_vocals)
-        shutil.copy(no_vocals_path, final_instr)
+            torchaudio.save(str(final_vocals), vocals.cpu(), demucs_model.samplerate)
+            torchaudio.save(str(final_instr), no_vocals.cpu(), demucs_model.samplerate)
 
-        logger.info(f"[Demucs] Vocals saved to: {final_vocals}")
-        logger.info(f"[Demucs] Instrumental saved to: {final_instr}")
+            logger.info(f"[Demucs] Vocals saved to: {final_vocals}")
+            logger.info(f"[Demucs] Instrumental saved to: {final_instr}")
+            results[index] = (final_vocals, final_instr)
 
-        return final_vocals, final_instr
+        del sources
 
+        return results if batched else results[0]
 
 if __name__ == "__main__":
     d_p = DemucsProcessor()
@@ -1,4 +1,5 @@
-from confluent_kafka import Producer, Consumer, KafkaError
+from confluent_kafka import Producer, Consumer, KafkaError, TopicPartition
+from collections import deque
 import threading
 import os
 import logging
@@ -44,8 +45,19 @@ class KafkaMessageConsumer:
             "enable.auto.commit": False
         })
         self.consumer.subscribe([self.topic])
+        # commit=False: offsets taken per partition, in poll order, and those already processed
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._processed = {}
 
-    def consume_messages(self, handler_fn):
+    def consume_messages(self, handler_fn, commit=True):
+        """
+        Calls handler_fn(key, value) for every message and commits it afterwards.
+        With commit=False handler_fn(key, value, msg) gets the message itself and
+        must call commit(msg) once the message is really processed; messages may
+        finish in any order.
+        The consumer stays open; call close() when done
+        """
         try:
             self.logger.info(f"[Consumer] Subscribed to {self.topic} | Group: {self.group}")
             while True:
@@ -60,12 +72,38 @@ class KafkaMessageConsumer:
                         break
                 key = msg.key().decode("utf-8") if msg.key() else None
                 value = msg.value().decode("utf-8")
-                handler_fn(key, value)
-                self.consumer.commit(msg)
+                if commit:
+                    handler_fn(key, value)
+                    self.consumer.commit(msg)
+                else:
+                    with self._lock:
+                        partition = (msg.topic(), msg.partition())
+                        self._in_flight.setdefault(partition, deque()).append(msg.offset())
+                    handler_fn(key, value, msg)
         except KeyboardInterrupt:
             self.logger.info("[Consumer] Interrupted by user.")
-        finally:
-            self.consumer.close()
+
+    def commit(self, msg):
+        """
+        Marks msg as processed and commits its partition up to the last offset
+        with no unprocessed message before it: a Kafka commit covers every
+        earlier offset, so msg alone may not be committed yet.
+        Safe to call from other threads
+        """
+        partition = (msg.topic(), msg.partition())
+        with self._lock:
+            in_flight = self._in_flight.get(partition)
+            if not in_flight:
+                return
+            processed = self._processed.setdefault(partition, set())
+            processed.add(msg.offset())
+            last = None
+            while in_flight and in_flight[0] in processed:
+                last = in_flight.popleft()
+                processed.discard(last)
+            if last is None:
+                return
+            self.consumer.commit(offsets=[TopicPartition(*partition, last + 1)], asynchronous=True)
 
     def close(self):
         self.consumer.close()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import numpy as np
+import soundfile as sf
+import soxr
+from functools import lru_cache
+
+from mixer_processing_legacy import AudioMixer
+
+
+class NumpyMixer(AudioMixer):
+    """
+    Микшер без ffmpeg для WAV из пайплайна: чтение через soundfile (+ soxr при
+    другой частоте), косинусные fade-in/out. Нормализация и выравнивание —
+    те же float32-операции NumPy, что и в AudioMixer; WAV пишется в PCM_16
+    """
+
+    def _check_ffmpeg_installed(self):
+        """ffmpeg не нужен: WAV читает и пишет libsndfile"""
+
+    def _read(self, path):
+        """Читает файл в float32 формы (samples, channels) с частотой и числом каналов микшера"""
+        audio, sr = sf.read(str(path), dtype="float32", always_2d=True)
+        if sr != self.sample_rate:
+            audio = soxr.resample(audio, sr, self.sample_rate, quality="HQ")
+        if audio.shape[1] != self.channels:
+            mono = audio.mean(axis=1, keepdims=True)
+            audio = np.repeat(mono, self.channels, axis=1)
+        return np.ascontiguousarray(audio, dtype=np.float32)
+
+    def load_vocal(self, path):
+        """Загрузка вокального трека"""
+        self.vocal_path = path
+        self.vocal_np = self._read(path)
+
+    def load_instrumental(self, path):
+        """Загрузка инструментального трека"""
+        self.instrumental_path = path
+        self.instrumental_np = self._read(path)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _fade_window(n):
+        """Косинусное окно 0→1 формы (n, 1): 0.5 * (1 - cos(0..π)); кешируется"""
+        window = (0.5 * (1 - np.cos(np.linspace(0, np.pi, n)))).astype(np.float32)[:, None]
+        window.flags.writeable = False
+        return window
+
+    @staticmethod
+    def fade_in_out(audio, fade_duration=500, sample_rate=44100):
+        """Применяет косинусные fade-in и fade-out к аудио (на месте)"""
+        n = min(int(fade_duration * sample_rate / 1000), len(audio) // 2)
+        if n == 0:
+            return audio
+        window = NumpyMixer._fade_window(n)
+        audio[:n] *= window
+        audio[-n:] *= window[::-1]
+        return audio
+
+    def export_mixed_audio(self, output_path, subtype="PCM_16", **mix_kwargs):
+        """
+        Экспорт смешанного аудио в файл через soundfile
+        :param output_path: путь для сохранения результата (формат libsndfile по расширению)
+        :param subtype: формат сэмплов libsndfile
+        :param mix_kwargs: аргументы для mix_audio
+        """
+        sf.write(str(output_path), self.mix_audio(**mix_kwargs), self.sample_rate, subtype=subtype)
+
+
+if __name__ == "__main__":
+    mixer = NumpyMixer("vocal.wav", "instrumental.wav")
+    mixer.normalize_audio(target_dBFS=-18.0, instrumental_offset=-2.5)
+    mixer.align_durations(strategy="pad")
+    mixer.export_mixed_audio("final_mix.wav", vocal_volume=0.95, instrumental_volume=0.85, fade_duration=800)
+    print(mixer.get_audio_info())
@@ -1,22 +1,30 @@
 import numpy as np
-from pydub import AudioSegment
-import tempfile
+import soundfile as sf
 import subprocess
+from functools import lru_cache
 from pathlib import Path
+import shutil
+
+# Путь к ffmpeg ищется один раз на процесс, а не при каждом создании микшера
+_FFMPEG = shutil.which("ffmpeg")
 
 
 class AudioMixer:
-    def __init__(self, vocal_path=None, instrumental_path=None):
+    def __init__(self, vocal_path=None, instrumental_path=None, sample_rate=44100, channels=2):
         """
         Инициализация микшера с путями к аудиофайлам
         :param vocal_path: путь к файлу с вокалом (поддерживаются WAV, MP3, FLAC и др.)
         :param instrumental_path: путь к файлу с инструменталом
+        :param sample_rate: частота дискретизации, к которой приводятся оба трека
+        :param channels: число каналов, к которому приводятся оба трека
         """
         self._check_ffmpeg_installed()
         self.vocal_path = vocal_path
         self.instrumental_path = instrumental_path
-        self.vocal_audio = None
-        self.instrumental_audio = None
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.vocal_np = None
+        self.instrumental_np = None
 
         if vocal_path:
             self.load_vocal(vocal_path)
@@ -24,13 +32,8 @@ class AudioMixer:
             self.load_instrumental(instrumental_path)
 
     def _check_ffmpeg_installed(self):
-        """Проверяет наличие FFmpeg в системе и устанавливает если нужно"""
-        try:
-            subprocess.run(["ffmpeg", "-version"],
-                           check=True,
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL)
-        except (subprocess.CalledProcessError, FileNotFoundError):
+        """Проверяет наличие FFmpeg в системе (результат поиска кешируется при импорте модуля)"""
+        if _FFMPEG is None:
             raise RuntimeError(
                 "FFmpeg не установлен. Установите FFmpeg для работы с аудио:\n"
                 "Linux: sudo apt install ffmpeg\n"
@@ -38,21 +41,53 @@ class AudioMixer:
                 "Windows: скачайте с https://ffmpeg.org/"
             )
 
+    @staticmethod
+    def _ffmpeg_read(path, sr=44100, ch=2):
+        """Декодирует файл через ffmpeg сразу в float32-массив формы (samples, channels)"""
+        out = subprocess.check_output([
+            _FFMPEG, "-v", "quiet", "-i", str(path),
+            "-f", "f32le", "-ar", str(sr), "-ac", str(ch),
+            "pipe:1"
+        ])
+        return np.frombuffer(out, dtype=np.float32).reshape(-1, ch)
+
     def load_vocal(self, path):
         """Загрузка вокального трека"""
         self.vocal_path = path
-        self.vocal_audio = AudioSegment.from_file(path)
+        self.vocal_np = self._ffmpeg_read(path, self.sample_rate, self.channels)
 
     def load_instrumental(self, path):
         """Загрузка инструментального трека"""
         self.instrumental_path = path
-        self.instrumental_audio = AudioSegment.from_file(path)
+        self.instrumental_np = self._ffmpeg_read(path, self.sample_rate, self.channels)
 
     def check_audio_files(self):
         """Проверка загружены ли оба аудиофайла"""
-        if self.vocal_audio is None or self.instrumental_audio is None:
+        if self.vocal_np is None or self.instrumental_np is None:
             raise ValueError("Оба аудиофайла должны быть загружены перед сведением")
 
+    @staticmethod
+    def _dbfs(arr):
+        """Уровень сигнала в dBFS (RMS относительно полной шкалы)"""
+        return 20 * np.log10(np.sqrt(np.vdot(arr, arr) / arr.size) + 1e-12)
+
+    @staticmethod
+    def apply_gain(arr, db):
+        """Усиление/ослабление сигнала на db децибел"""
+        return arr * np.float32(10 ** (db / 20))
+
+    @staticmethod
+    def _apply_gain_inplace(arr, db):
+        """
+        То же, что apply_gain, но без лишней аллокации. Буферы прямо из ffmpeg
+        только для чтения, поэтому для них один раз создаётся копия
+        """
+        gain = np.float32(10 ** (db / 20))
+        if not arr.flags.writeable:
+            return arr * gain
+        arr *= gain
+        return arr
+
     def normalize_audio(self, target_dBFS=-20.0, instrumental_offset=-3.0):
         """
         Нормализация громкости аудиофайлов
@@ -62,13 +97,13 @@ class AudioMixer:
         self.check_audio_files()
 
         # Нормализация вокала
-        vocal_change = target_dBFS - self.vocal_audio.dBFS
-        self.vocal_audio = self.vocal_audio.apply_gain(vocal_change)
+        vocal_change = target_dBFS - self._dbfs(self.vocal_np)
+        self.vocal_np = self._apply_gain_inplace(self.vocal_np, vocal_change)
 
         # Нормализация инструментала
         instrumental_target = target_dBFS + instrumental_offset
-        instrumental_change = instrumental_target - self.instrumental_audio.dBFS
-        self.instrumental_audio = self.instrumental_audio.apply_gain(instrumental_change)
+        instrumental_change = instrumental_target - self._dbfs(self.instrumental_np)
+        self.instrumental_np = self._apply_gain_inplace(self.instrumental_np, instrumental_change)
 
     def align_durations(self, strategy="trim"):
         """
@@ -80,35 +115,32 @@ class AudioMixer:
         """
         self.check_audio_files()
 
-        vocal_len = len(self.vocal_audio)
-        instrumental_len = len(self.instrumental_audio)
+        vocal_len = len(self.vocal_np)
+        instrumental_len = len(self.instrumental_np)
 
         if vocal_len == instrumental_len:
             return
 
         if strategy == "trim":
             if vocal_len > instrumental_len:
-                self.vocal_audio = self.vocal_audio[:instrumental_len]
+                self.vocal_np = self.vocal_np[:instrumental_len]
             else:
-                self.instrumental_audio = self.instrumental_audio[:vocal_len]
+                self.instrumental_np = self.instrumental_np[:vocal_len]
 
         elif strategy == "loop":
             if vocal_len > instrumental_len:
                 loops = int(np.ceil(vocal_len / instrumental_len))
-                self.instrumental_audio = self.instrumental_audio * loops
-                self.instrumental_audio = self.instrumental_audio[:vocal_len]
+                self.instrumental_np = np.tile(self.instrumental_np, (loops, 1))[:vocal_len]
             else:
                 loops = int(np.ceil(instrumental_len / vocal_len))
-                self.vocal_audio = self.vocal_audio * loops
-                self.vocal_audio = self.vocal_audio[:instrumental_len]
+                self.vocal_np = np.tile(self.vocal_np, (loops, 1))[:instrumental_len]
 
         elif strategy == "pad":
-            silence = AudioSegment.silent(duration=abs(vocal_len - instrumental_len),
-                                          frame_rate=self.vocal_audio.frame_rate)
+            diff = abs(vocal_len - instrumental_len)
             if vocal_len > instrumental_len:
-                self.instrumental_audio += silence
+                self.instrumental_np = np.pad(self.instrumental_np, ((0, diff), (0, 0)))
             else:
-                self.vocal_audio += silence
+                self.vocal_np = np.pad(self.vocal_np, ((0, diff), (0, 0)))
 
     def mix_audio(self, vocal_volume=1.0, instrumental_volume=0.8, fade_duration=500):
         """
@@ -116,21 +148,23 @@ class AudioMixer:
         :param vocal_volume: громкость вокала (0.0 - 1.0)
         :param instrumental_volume: громкость инструментала (0.0 - 1.0)
         :param fade_duration: длительность fade-in/out в миллисекундах
-        :return: смешанный аудиосегмент
+        :return: смешанный сигнал float32 формы (samples, channels)
         """
         self.check_audio_files()
         self.align_durations()
 
         # Применяем уровни громкости
-        vocal = self.vocal_audio - (20 * (1 - vocal_volume))
-        instrumental = self.instrumental_audio - (20 * (1 - instrumental_volume))
+        vocal = self.apply_gain(self.vocal_np, -20 * (1 - vocal_volume))
+        instrumental = self.apply_gain(self.instrumental_np, -20 * (1 - instrumental_volume))
 
         # Применяем fade-in/out
-        vocal = self.fade_in_out(vocal, fade_duration)
-        instrumental = self.fade_in_out(instrumental, fade_duration)
+        vocal = self.fade_in_out(vocal, fade_duration, self.sample_rate)
+        instrumental = self.fade_in_out(instrumental, fade_duration, self.sample_rate)
 
         # Смешиваем треки
-        mixed = vocal.overlay(instrumental)
+        mixed = vocal
+        mixed += instrumental
+        np.clip(mixed, -1.0, 1.0, out=mixed)
 
         return mixed
 
@@ -145,42 +179,59 @@ class AudioMixer:
         # Определяем формат по расширению файла
         ext = Path(output_path).suffix[1:].lower()
 
-        # Особые параметры для FLAC
         if ext == "flac":
-            # Используем временный WAV файл для конвертации в FLAC
-            with tempfile.NamedTemporaryFile(suffix=".wav") as tmp_wav:
-                mixed.export(tmp_wav.name, format="wav")
-
-                # Конвертируем в FLAC с максимальным качеством
-                subprocess.run([
-                    "ffmpeg", "-y", "-i", tmp_wav.name,
-                    "-c:a", "flac", "-compression_level", "12",
-                    output_path
-                ], check=True)
+            # libFLAC напрямую через soundfile, без запуска ffmpeg
+            sf.write(output_path, mixed, self.sample_rate, format="FLAC", subtype="PCM_24")
+        elif ext.upper() in sf.available_formats():
+            sf.write(output_path, mixed, self.sample_rate)
         else:
-            # Для других форматов используем стандартный экспорт
-            mixed.export(output_path, format=ext)
+            # Форматы, которые libsndfile не пишет: сырой PCM в ffmpeg через stdin
+            proc = subprocess.Popen([
+                _FFMPEG, "-y",
+                "-f", "f32le",
+                "-ar", str(self.sample_rate),
+                "-ac", str(self.channels),
+                "-i", "pipe:0",
+                output_path
+            ], stdin=subprocess.PIPE)
+            proc.communicate(mixed.tobytes())
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _fade_ramp(n):
+        """Линейная рампа 0→1 формы (n, 1); кешируется, чтобы оба трека делили одну"""
+        ramp = np.linspace(0, 1, n, dtype=np.float32)[:, None]
+        ramp.flags.writeable = False
+        return ramp
 
     @staticmethod
-    def fade_in_out(audio_segment, fade_duration=500):
-        """Применяет fade-in и fade-out к аудио"""
-        return audio_segment.fade_in(fade_duration).fade_out(fade_duration)
+    def fade_in_out(audio, fade_duration=500, sample_rate=44100):
+        """Применяет fade-in и fade-out к аудио (на месте)"""
+        n = min(int(fade_duration * sample_rate / 1000), len(audio) // 2)
+        if n == 0:
+            return audio
+        ramp = AudioMixer._fade_ramp(n)
+        audio[:n] *= ramp
+        audio[-n:] *= ramp[::-1]
+        return audio
 
     def get_audio_info(self):
         """Возвращает информацию о аудиофайлах"""
         self.check_audio_files()
         return {
             "vocal": {
-                "duration": len(self.vocal_audio) / 1000,
-                "channels": self.vocal_audio.channels,
-                "sample_rate": self.vocal_audio.frame_rate,
-                "dBFS": self.vocal_audio.dBFS
+                "duration": len(self.vocal_np) / self.sample_rate,
+                "channels": self.channels,
+                "sample_rate": self.sample_rate,
+                "dBFS": self._dbfs(self.vocal_np)
             },
             "instrumental": {
-                "duration": len(self.instrumental_audio) / 1000,
-                "channels": self.instrumental_audio.channels,
-                "sample_rate": self.instrumental_audio.frame_rate,
-                "dBFS": self.instrumental_audio.dBFS
+                "duration": len(self.instrumental_np) / self.sample_rate,
+                "channels": self.channels,
+                "sample_rate": self.sample_rate,
+                "dBFS": self._dbfs(self.instrumental_np)
             }
         }
 
@@ -51,18 +51,22 @@ def mount_nfs_in_self(
         if not os.path.exists('/.dockerenv'):
             raise RuntimeError("Этот код должен выполняться внутри Docker-контейнера")
 
+        # Уже смонтировано - повторно монтировать не нужно
+        if os.path.ismount(mount_point):
+            return True
+
         # Создаем точку монтирования
         os.makedirs(mount_point, exist_ok=True)
 
-        # Формируем команду монтирования
-        mount_cmd = f"mount -t nfs -o {options} {nfs_server_ip}:{nfs_path} {mount_point}"
+        # Формируем команду монтирования (без shell)
+        mount_cmd = ["mount", "-t", "nfs", "-o", options, f"{nfs_server_ip}:{nfs_path}", mount_point]
 
         # Выполняем с несколькими попытками (NFS может быть медленным)
-        for attempt in range(max(1, timeout // 5)):
+        attempts = max(1, timeout // 5)
+        for attempt in range(attempts):
             try:
                 subprocess.run(
                     mount_cmd,
-                    shell=True,
                     check=True,
                     stderr=subprocess.PIPE,
                     stdout=subprocess.PIPE
@@ -71,9 +75,10 @@ def mount_nfs_in_self(
                 if os.path.ismount(mount_point):
                     return True
             except subprocess.CalledProcessError:
-                if attempt == (timeout // 5) - 1:
+                if attempt == attempts - 1:
                     raise
-                time.sleep(5)
+                # Экспоненциальная задержка между попытками
+                time.sleep(min(30, 2 ** attempt))
 
         return False
 
@@ -1,17 +1,20 @@
-import ffmpeg
-import noisereduce as nr
+import subprocess
+import io
 import librosa
 import soundfile as sf
+import soxr
 from pathlib import Path
 import logging
 import numpy as np
+import torch
+from toolbox.dsp_kernels import spectral_subtract
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
 
 class AudioRestorer:
-    def __init__(self, sr=44100, mode="gentle", vinyl_intensity="medium"):
+    def __init__(self, sr=44100, mode="gentle", vinyl_intensity="medium", device="auto"):
         """
         :param sr: Sample rate
         :param mode: Processing mode:
@@ -19,38 +22,80 @@ class AudioRestorer:
             - 'ultra_gentle': minimal processing
             - 'vinyl': specialized vinyl processing
         :param vinyl_intensity: Vinyl processing intensity ('light', 'medium', 'aggressive')
+        :param device: Torch device for spectral subtraction ('auto', 'cpu', 'cuda', 'cuda:N');
+            pass DemucsProcessor.device to stay on the GPU context Demucs already uses
         """
         self.sr = sr
         self.mode = mode
         self.vinyl_intensity = vinyl_intensity
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self._nr_device = torch.device(device)
         self.ffmpeg_params = {
             'light': {'nr': 15, 'nf': -20, 'hpf': 60, 'lpf': 12000},
             'medium': {'nr': 25, 'nf': -25, 'hpf': 50, 'lpf': 10000},
             'aggressive': {'nr': 40, 'nf': -35, 'hpf': 40, 'lpf': 8000}
         }
 
-    def _process_vinyl(self, input_path, output_path):
-        """Universal vinyl processing using only compatible filters"""
-        params = self.ffmpeg_params[self.vinyl_intensity]
+        # Intensity is fixed per instance, so the filtergraph is built once here
+        params = self.ffmpeg_params[vinyl_intensity]
+        self._vinyl_filterchain = ",".join([
+            # 1. Broadband noise reduction (compatible with all versions)
+            f"afftdn=nr={params['nr']}:nf={params['nf']}",
+            # 2. Click removal using highpass+lowpass
+            f"highpass=f={params['hpf']}",
+            f"lowpass=f={params['lpf']}",
+            # 3. Dynamic normalization
+            "dynaudnorm=framelen=500",
+            # 4. Mild exciter for HF restoration
+            "equalizer=f=10000:t=q:w=1:g=1.5",
+        ])
+
+    @staticmethod
+    def _load_wav(path, block_frames=1 << 16):
+        """
+        Read a file as mono float32 straight into one preallocated buffer.
+        Multichannel audio is downmixed block by block, so the full
+        (frames, channels) array is never held in memory
+        """
+        with sf.SoundFile(str(path)) as f:
+            buf = np.empty(f.frames, dtype=np.float32)
+            if f.channels == 1:
+                # On a short read soundfile returns out[:frames]; the rest of buf is uninitialized
+                buf = f.read(dtype='float32', out=buf)
+            else:
+                block = np.empty((block_frames, f.channels), dtype=np.float32)
+                pos = 0
+                while pos < f.frames:
+                    n = f.read(dtype='float32', out=block[:f.frames - pos]).shape[0]
+                    if n == 0:  # header promised more frames than the file holds
+                        buf = buf[:pos]
+                        break
+                    np.mean(block[:n], axis=1, out=buf[pos:pos + n])
+                    pos += n
+            return buf, f.samplerate
+
+    def _load(self, path):
+        """Load audio as mono float32 at self.sr (soundfile + soxr instead of librosa/resampy)"""
+        y, sr_native = self._load_wav(path)
+        if sr_native != self.sr:
+            y = soxr.resample(y, sr_native, self.sr, quality='HQ')
+        # float32 + C order end-to-end: half the bytes of float64 and SIMD-friendly
+        return np.ascontiguousarray(y, dtype=np.float32), self.sr
+
+    def _vinyl_ffmpeg(self, input_path, output_args):
+        """Universal vinyl processing using only compatible filters; returns ffmpeg stdout"""
+        # One ffmpeg call with a single filtergraph
+        return subprocess.run(
+            ["ffmpeg", "-y", "-threads", "0", "-i", str(input_path),
+             "-af", self._vinyl_filterchain, "-ar", str(self.sr), *output_args],
+            check=True, capture_output=True
+        ).stdout
 
+    def _process_vinyl(self, input_path, output_path):
         try:
-            (
-                ffmpeg
-                .input(input_path)
-                # 1. Broadband noise reduction (compatible with all versions)
-                .filter('afftdn', nr=params['nr'], nf=params['nf'])
-                # 2. Click removal using highpass+lowpass
-                .filter('highpass', f=params['hpf'])
-                .filter('lowpass', f=params['lpf'])
-                # 3. Dynamic normalization
-                .filter('dynaudnorm', framelen=500)
-                # 4. Mild exciter for HF restoration
-                .filter('equalizer', frequency=10000, width_type='q', width=1, gain=1.5)
-                .output(output_path, ar=self.sr)
-                .overwrite_output()
-                .run(quiet=True)
-            )
-        except ffmpeg.Error as e:
+            self._vinyl_ffmpeg(input_path, [str(output_path)])
+        except subprocess.CalledProcessError as e:
             logger.error(f"FFmpeg processing failed. Try updating FFmpeg to version 5.0+")
             logger.error(f"Error details: {e.stderr.decode()}")
             # Fallback to Python-only processing
@@ -58,32 +103,63 @@ class AudioRestorer:
 
     def _fallback_vinyl_processing(self, input_path, output_path):
         """Python-only fallback when FFmpeg fails"""
-        logger.warning("Using Python-only fallback processing")
-        y, sr = librosa.load(input_path, sr=self.sr)
+        y, sr = self._load(input_path)
+        sf.write(output_path, self._fallback_vinyl(y, sr), sr, subtype='FLOAT')
 
+    def _fallback_vinyl(self, y, sr):
+        logger.warning("Using Python-only fallback processing")
         # 1. Noise reduction
-        noise_profile = y[:int(0.2 * sr)]
-        y_clean = nr.reduce_noise(
-            y=y, sr=sr, y_noise=noise_profile,
-            stationary=False,
-            n_fft=4096,
-            prop_decrease=0.7
-        )
+        y_clean = self._spectral_subtract(y, sr, prop_decrease=0.7, device=self._nr_device)
 
         # 2. Highpass filter
-        y_clean = librosa.effects.preemphasis(y_clean, coef=0.92)
+        return self._preemphasis(y_clean, coef=0.92, inplace=True)
+
+    @staticmethod
+    def _preemphasis(y, coef, inplace=False):
+        """First-order pre-emphasis y[n] - coef * y[n-1] without scipy's lfilter"""
+        out = y if inplace else y.copy()
+        out[1:] -= np.float32(coef) * y[:-1]
+        return out
 
-        sf.write(output_path, y_clean, sr)
+    @staticmethod
+    def _spectral_subtract(y, sr, prop_decrease, n_fft=4096, hop_length=1024, device=None):
+        """
+        Spectral subtraction on a single STFT; the noise profile is the mean
+        magnitude of the first 0.2 s (same noise clip noisereduce was given).
+        On a CUDA device the STFT/iSTFT run through torch, otherwise librosa + Numba
+        """
+        y = np.ascontiguousarray(y, dtype=np.float32)
+        if device is not None and device.type == "cuda":
+            return AudioRestorer._spectral_subtract_torch(y, sr, prop_decrease, n_fft, hop_length, device)
+        S = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)  # complex64 for float32 input
+        noise = np.abs(S[:, :max(1, int(0.2 * sr / hop_length))]).mean(axis=1)
+        S_clean = spectral_subtract(S, noise, prop_decrease)
+        y_clean = librosa.istft(S_clean, hop_length=hop_length, length=len(y))
+        return y_clean.astype(np.float32, copy=False)
+
+    @staticmethod
+    @torch.inference_mode()
+    def _spectral_subtract_torch(y, sr, prop_decrease, n_fft, hop_length, device):
+        """GPU version of _spectral_subtract; framing matches librosa (centered, zero padded, hann)"""
+        x = torch.from_numpy(y).to(device, non_blocking=True)
+        window = torch.hann_window(n_fft, device=device)
+        S = torch.stft(x, n_fft, hop_length=hop_length, window=window,
+                       center=True, pad_mode="constant", return_complex=True)
+        mag = S.abs()
+        noise = mag[:, :max(1, int(0.2 * sr / hop_length))].mean(dim=1, keepdim=True)
+        gain = (mag - prop_decrease * noise).clamp_min_(0).div_(mag + 1e-12)
+        y_clean = torch.istft(S * gain, n_fft, hop_length=hop_length, window=window, length=len(y))
+        return y_clean.cpu().numpy()
 
     def _gentle_denoise(self, y, sr):
         """Gentle noise reduction"""
-        noise_profile = y[:int(0.2 * sr)]
-        return nr.reduce_noise(
-            y=y, sr=sr, y_noise=noise_profile,
-            stationary=False,
-            n_fft=4096,
-            prop_decrease=0.5
-        )
+        return self._spectral_subtract(y, sr, prop_decrease=0.5, device=self._nr_device)
+
+    def _denoise(self, y, sr):
+        """Non-vinyl modes"""
+        if self.mode == "ultra_gentle":
+            return self._preemphasis(y, coef=0.85)
+        return self._gentle_denoise(y, sr)
 
     def restore(self, input_path, output_path):
         input_path = Path(input_path)
@@ -95,14 +171,8 @@ class AudioRestorer:
             if self.mode == "vinyl":
                 self._process_vinyl(str(input_path), str(output_path))
             else:
-                y, sr = librosa.load(str(input_path), sr=self.sr)
-
-                if self.mode == "ultra_gentle":
-                    y_clean = librosa.effects.preemphasis(y, coef=0.85)
-                else:
-                    y_clean = self._gentle_denoise(y, sr)
-
-                sf.write(str(output_path), y_clean, sr)
+                y, sr = self._load(input_path)
+                sf.write(str(output_path), self._denoise(y, sr), sr, subtype='FLOAT')
 
             logger.info(f"Successfully saved to: {output_path}")
             return True
@@ -110,6 +180,29 @@ class AudioRestorer:
             logger.error(f"Processing failed: {str(e)}")
             return False
 
+    def restore_to_bytes(self, input_path) -> bytes:
+        """
+        Same as restore(), but returns the result as an in-memory WAV instead
+        of writing it to disk (ffmpeg writes to pipe:1). Raises on failure
+        """
+        logger.info(f"Starting {self.mode} restoration to memory...")
+
+        if self.mode == "vinyl":
+            try:
+                return self._vinyl_ffmpeg(input_path, ["-f", "wav", "pipe:1"])
+            except subprocess.CalledProcessError as e:
+                logger.error(f"FFmpeg processing failed. Try updating FFmpeg to version 5.0+")
+                logger.error(f"Error details: {e.stderr.decode()}")
+            y, sr = self._load(input_path)
+            y_clean = self._fallback_vinyl(y, sr)
+        else:
+            y, sr = self._load(input_path)
+            y_clean = self._denoise(y, sr)
+
+        buf = io.BytesIO()
+        sf.write(buf, y_clean, sr, format='WAV', subtype='FLOAT')
+        return buf.getvalue()
+
 
 if __name__ == "__main__":
     # Gentle mode (default)
@@ -2,96 +2,245 @@ from noisereduce_processing import AudioRestorer
 from demucs_processing import DemucsProcessor
 from fixer_processing import VoiceImprover
 from convertor import AudioConverter
-from mixer_processing_legacy import AudioMixer
-from toolbox.common import make_name
-import shutil
+from mixer_processing import NumpyMixer
+from toolbox.common import derive
+from toolbox.amp import resolve_amp_dtype
+from pathlib import Path
+import threading
+import queue
 import logging
 import time
-import os
+import torch
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 
-def run(input_path, nfs_dir, uuid: 0):
-
-    logger.info("Starting...")
-    start_time = time.time()
-    try:
-
-        work_dir = nfs_dir + str(uuid) + '/'
-        os.makedirs(work_dir, exist_ok=True)
-
-        # Setting up the instances of processing tools
-        audio_converter = AudioConverter()
-        pre_restorer = AudioRestorer(mode="vinyl", vinyl_intensity="aggressive")
-        post_restorer = AudioRestorer(mode="vinyl", vinyl_intensity="light")
-        track_splitter = DemucsProcessor()
-        fixer = VoiceImprover()
-
-
-        # Starting pipeline
-
+class Pipeline:
+    def __init__(self, queue_size: int = 2, amp: bool = True):
+        # Setting up the instances of processing tools once per process:
+        # model weights stay loaded between messages
+        logger.info("Initializing pipeline...")
+        self.audio_converter = AudioConverter()
+        # One autocast dtype for both GPU models: BF16 where supported, FP16 otherwise
+        self.amp_dtype = resolve_amp_dtype(amp)
+        self.track_splitter = DemucsProcessor(model="hdemucs_mmi", amp=self.amp_dtype or False)
+        # Python-side denoising runs on the same device as Demucs
+        self.pre_restorer = AudioRestorer(mode="vinyl", vinyl_intensity="aggressive",
+                                          device=self.track_splitter.device)
+        self.post_restorer = AudioRestorer(mode="vinyl", vinyl_intensity="light",
+                                           device=self.track_splitter.device)
+        self.fixer = VoiceImprover(amp=self.amp_dtype or False)
+
+        # Demucs and VoiceFixer share one CUDA stream so GPU stages don't contend
+        self.gpu_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.fixer._stream = self.gpu_stream
+
+        self.stages = [
+            self.stage_convert,
+            self.stage_denoise,
+            self.stage_separate,
+            self.stage_enhance,
+            self.stage_post,
+            self.stage_mix,
+        ]
+        # GPU stages take the whole batch of jobs and run it through the model at once
+        self.batch_stages = {self.stage_separate, self.stage_enhance}
+        self.queue_size = queue_size
+        self._queues = []
+        self._threads = []
+        logger.info("Pipeline initialized")
+
+    # Stages: each takes a job dict (batch stages: a list of them), fills in its outputs and returns it
+
+    def stage_convert(self, job):
         # 0. Convertion
-        s_path = audio_converter.convert_name(input_path)
-        audio_path = str(audio_converter.to_wav(input_path=str(s_path)))
-
+        s_path = self.audio_converter.convert_name(job["input_path"])
+        job["audio_path"] = self.audio_converter.to_wav(input_path=str(s_path))
         logger.info("Step 0 done")
+        return job
 
-        # 1. Noise reduction
-        denoised_path = work_dir + make_name(audio_path, suffix='-denoised')
-        pre_restorer.restore(
-            input_path=audio_path,
-            output_path=denoised_path
-        )
+    def stage_denoise(self, job):
+        # 1. Noise reduction: result stays in memory and goes straight to Demucs
+        job["denoised_wav"] = self.pre_restorer.restore_to_bytes(input_path=job["audio_path"])
         logger.info("Step 1 done")
-
-        # 2. Track splitting
-        vocals, instruments = track_splitter.separate(input_path=denoised_path, output_dir=work_dir, model="hdemucs_mmi", mode='vintage')
+        return job
+
+    def stage_separate(self, jobs):
+        # 2. Track splitting: one padded Demucs batch for all jobs
+        with torch.cuda.stream(self.gpu_stream):
+            stems = self.track_splitter.separate(
+                input_path=[job.pop("denoised_wav") for job in jobs],
+                output_dir=[job["work_dir"] for job in jobs],
+                model="hdemucs_mmi", mode='vintage',
+                name=[derive(job["audio_path"], job["work_dir"], '-denoised').stem for job in jobs]
+            )
+        for job, result in zip(jobs, stems):
+            if result is None:
+                job["error"] = RuntimeError(f"Track splitting failed for {job['audio_path']}")
+                continue
+            job["vocals"], job["instruments"] = result
         logger.info("Step 2 done")
-
-        # 3. Vocal enhancing
-        enhanced_vocal_path = work_dir + make_name(vocals, suffix='-enhanced')
-        print(vocals)
-        print(enhanced_vocal_path)
-        fixer.process(
-            input_path=vocals,
-            output_path=enhanced_vocal_path,
-            mode=1
-        )
+        return jobs
+
+    def stage_enhance(self, jobs):
+        # 3. Vocal enhancing: VoiceFixer segments of all jobs share forward passes
+        for job in jobs:
+            job["enhanced_vocal_path"] = derive(job["vocals"], job["work_dir"], '-enhanced')
+        with torch.cuda.stream(self.gpu_stream):
+            results = self.fixer.process(
+                input_path=[str(job["vocals"]) for job in jobs],
+                output_path=[str(job["enhanced_vocal_path"]) for job in jobs],
+                mode=1
+            )
+        for job, result in zip(jobs, results):
+            if result is None:
+                job["error"] = RuntimeError(f"Vocal enhancing failed for {job['vocals']}")
         logger.info("Step 3 done")
+        return jobs
+
+    def stage_post(self, job):
         # 4. Cleaning artifacts
-        final_vocal_path = work_dir + make_name(enhanced_vocal_path, suffix='-final')
-        post_restorer.restore(
-            input_path=enhanced_vocal_path,
-            output_path=final_vocal_path
+        job["final_vocal_path"] = derive(job["enhanced_vocal_path"], job["work_dir"], '-final')
+        self.post_restorer.restore(
+            input_path=job["enhanced_vocal_path"],
+            output_path=job["final_vocal_path"]
         )
         logger.info("Step 4 done")
+        return job
 
+    def stage_mix(self, job):
         # 5. Mastering
-        mixer = AudioMixer(vocal_path=final_vocal_path, instrumental_path=instruments)
+        mixer = NumpyMixer(vocal_path=job["final_vocal_path"], instrumental_path=job["instruments"])
         mixer.normalize_audio(target_dBFS=-18.0, instrumental_offset=-2.5)
         mixer.align_durations(strategy="pad")
-        final_output_path = work_dir + make_name(audio_path, suffix='-improved-mastered')
+        job["final_output_path"] = derive(job["audio_path"], job["work_dir"], '-improved-mastered')
         mixer.export_mixed_audio(
-            final_vocal_path,
+            job["final_output_path"],
             vocal_volume=0.95,
             instrumental_volume=0.85,
             fade_duration=800
         )
         logger.info("Step 5 done")
-
-        # Cleaning demucs temp files
-        shutil.rmtree("separated/hdemucs_mmi")
-
-        process_time = time.time() - start_time
-        logger.info(f"Done! Pipeline worked in {process_time:.2f}s")
-        return 0, final_output_path, final_vocal_path
-    except Exception as e:
-        logger.error(e)
-        return 1, None, None
-
-
+        return job
+
+    @staticmethod
+    def _new_job(input_path, nfs_dir, uuid, **extra):
+        # nfs_dir is a prefix, not a parent directory: "<nfs_dir><uuid>/"
+        work_dir = Path(f"{nfs_dir}{uuid}")
+        work_dir.mkdir(parents=True, exist_ok=True)
+        return {
+            "input_path": input_path,
+            "work_dir": work_dir,
+            "uuid": uuid,
+            "start_time": time.time(),
+            "error": None,
+            **extra,
+        }
+
+    @staticmethod
+    def _finish(job):
+        if job["error"] is not None:
+            return 1, None, None
+        process_time = time.time() - job["start_time"]
+        logger.info(f"Done! Pipeline {job['uuid']} worked in {process_time:.2f}s")
+        return 0, str(job["final_output_path"]), str(job["final_vocal_path"])
+
+    def _run_stage(self, stage, jobs):
+        """Runs one stage over a batch; a failure marks only the jobs it touched"""
+        live = [job for job in jobs if job["error"] is None]
+        if not live:
+            return
+        if stage in self.batch_stages:
+            try:
+                stage(live)
+            except Exception as e:
+                logger.error(e)
+                for job in live:
+                    job["error"] = e
+            return
+        for job in live:
+            try:
+                stage(job)
+            except Exception as e:
+                logger.error(e)
+                job["error"] = e
+
+    def run(self, input_path, nfs_dir, uuid: 0):
+        """Synchronous run: all stages one after another on the calling thread"""
+        return self.run_batch([dict(input_path=input_path, nfs_dir=nfs_dir, uuid=uuid)])[0]
+
+    def run_batch(self, batch):
+        """
+        Synchronous run of several tracks: GPU stages process them as one batch.
+        batch is a list of dicts with input_path, nfs_dir, uuid (and any extra
+        job fields); returns one result per item, same shape as run()
+        """
+        logger.info("Starting...")
+        try:
+            jobs = [self._new_job(**item) for item in batch]
+        except Exception as e:
+            logger.error(e)
+            return [(1, None, None)] * len(batch)
+        for stage in self.stages:
+            self._run_stage(stage, jobs)
+        return [self._finish(job) for job in jobs]
+
+    # Staged mode: one worker thread per stage, bounded queues between them,
+    # so CPU stages (ffmpeg, mixing) of one track overlap GPU stages of another
+
+    def start(self, on_done):
+        """
+        Starts stage workers. on_done(job, result) is called from the last
+        worker for every submitted job; result has the same shape as run()
+        """
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        self._threads = []
+        for index, stage in enumerate(self.stages):
+            inbox = self._queues[index]
+            outbox = self._queues[index + 1] if index + 1 < len(self.stages) else None
+            thread = threading.Thread(
+                target=self._worker, args=(stage, inbox, outbox, on_done),
+                name=f"pipeline-{stage.__name__}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, input_path, nfs_dir, uuid, **extra):
+        """Puts a job on the first stage queue; blocks while the pipeline is full"""
+        self.submit_batch([dict(input_path=input_path, nfs_dir=nfs_dir, uuid=uuid, **extra)])
+
+    def submit_batch(self, batch):
+        """Same as submit() for a list of job dicts (see run_batch); they travel the stages together"""
+        logger.info("Starting...")
+        self._queues[0].put([self._new_job(**item) for item in batch])
+
+    def stop(self):
+        """Drains submitted jobs and stops the workers"""
+        if not self._threads:
+            return
+        self._queues[0].put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _worker(self, stage, inbox, outbox, on_done):
+        while True:
+            jobs = inbox.get()
+            if jobs is not None:
+                self._run_stage(stage, jobs)
+
+            if outbox is not None:
+                outbox.put(jobs)
+            elif jobs is not None:
+                for job in jobs:
+                    try:
+                        on_done(job, self._finish(job))
+                    except Exception as e:
+                        logger.error(f"Pipeline result callback failed: {e}")
+
+            if jobs is None:
+                break
 
 
 if __name__ == '__main__':
-    run(input_path='audio/raw/Темная ночь.mp3', nfs_dir="audio-", uuid=4)
\ No newline at end of file
+    Pipeline().run(input_path='audio/raw/Темная ночь.mp3', nfs_dir="audio-", uuid=4)
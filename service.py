@@ -1,6 +1,8 @@
 import logging
-import json
+import orjson
 import time
+import queue
+import threading
 from kafka_tools import KafkaMessageConsumer, KafkaMessageProducer
 from config import KAFKA_TOPICS, KAFKA_CONSUMER_GROUPS, ACTOR_GRACE_PERIOD, NFS_MOUNT_POINT, NFS_IP
 import pipeline
@@ -23,11 +25,85 @@ consumer = KafkaMessageConsumer(topic=topic, group=group)
 
 # Инициализируем Kafka producer
 producer = KafkaMessageProducer(producer_topic)
-def serve(key, value):
+
+# Инициализируем пайплайн один раз: модели остаются загруженными между сообщениями
+_pipeline = pipeline.Pipeline()
+
+# Сообщения копятся в очереди и уходят в пайплайн батчами: до BATCH_SIZE штук
+# или сколько придёт за BATCH_WAIT секунд после первого. Очередь ограничена,
+# так что при занятом пайплайне serve блокируется и consumer перестаёт читать топик
+BATCH_SIZE = 4
+BATCH_WAIT = 0.05
+_incoming = queue.Queue(maxsize=BATCH_SIZE)
+
+def send_result(job, result):
+    """Отправка результата пайплайна (вызывается из последней стадии)"""
+    pipeline_uuid = job["uuid"]
+    pipeline_error_flag, final_path, vocals_path = result
+
+    if pipeline_error_flag == 0:
+        logger.info(f"Pipeline {pipeline_uuid} ended successfully!")
+    else:
+        logger.error(f"Pipeline {pipeline_uuid} encountered internal errors!")
+
+    message = orjson.dumps(
+        {
+            "uuid": pipeline_uuid,
+            "final_path": final_path,
+            "vocals_path": vocals_path,
+        }
+    ).decode()  # send_message ждёт str
+
+    logger.info(f"⏩ Producer is sending message to {producer_topic}")
+    producer.send_message(key=job["key"], value=message)
+
+    # Offset коммитится только после обработки: упавший или остановленный
+    # сервис получит незавершённые сообщения заново (at-least-once).
+    # consumer.commit не сдвинет offset дальше ещё не обработанных сообщений партиции
+    consumer.commit(job["message"])
+
+    logger.info(f"🚀 Work cycle on {pipeline_uuid} done!")
+
+
+def batcher():
+    """Собирает сообщения из _incoming в батчи и отдаёт их пайплайну; None — остановка"""
+    stopping = False
+    while not stopping:
+        item = _incoming.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = time.monotonic() + BATCH_WAIT
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = _incoming.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+
+        logger.info(f"Submitting batch of {len(batch)} message(s) to pipeline")
+        try:
+            _pipeline.submit_batch(batch)
+        except Exception as e:
+            logger.error(f"{NAME} | ❌ Error submitting batch: {e}")
+            for job in batch:
+                send_result(job, (1, None, None))
+
+
+def serve(key, value, msg):
     logger.info(f"{NAME}| ✴️ Got kafka message with key: {key}!")
-    """Обработка сообщений"""
+    """
+    Обработка сообщений; offset коммитит send_result, а битые сообщения serve
+    отмечает обработанными сразу — их offset уйдёт, когда завершатся предыдущие
+    """
     try:
-        data = json.loads(value)
+        data = orjson.loads(value)
         file_path = data.get("filePath")
         file_name = data.get("originalName")
 
@@ -37,30 +113,16 @@ def serve(key, value):
 
         logger.info(f"Assigned nfs uuid: {pipeline_uuid}")
 
-        pipeline_error_flag, final_path, vocals_path = pipeline.run(input_path=file_path, nfs_dir=file_path, uuid=pipeline_uuid)
-
-        if pipeline_error_flag is False:
-            logger.info(f"Pipeline {pipeline_uuid} ended successfully!")
-        else:
-            logger.error(f"Pipeline {pipeline_uuid} encountered internal errors!")
-
-        message = json.dumps(
-            {
-                "uuid": pipeline_uuid,
-                "final_path": final_path,
-                "vocals_path": vocals_path,
-            }
-        )
-
-        logger.info(f"⏩ Producer is sending message to {producer_topic}")
-        producer.send_message(key=key, value=message)
-
-        logger.info(f"🚀 Work cycle on {pipeline_uuid} done!")
+        # Батч соберёт batcher, стадии пайплайна работают в своих потоках,
+        # результат отправит send_result
+        _incoming.put(dict(input_path=file_path, nfs_dir=file_path, uuid=pipeline_uuid, key=key, message=msg))
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"{NAME} | ❌ JSON decoding error: {e}")
+        consumer.commit(msg)
     except Exception as e:
         logger.error(f"{NAME} | ❌ Error processing message: {e}")
+        consumer.commit(msg)
 
 
 if __name__ == "__main__":
@@ -72,13 +134,20 @@ if __name__ == "__main__":
         logger.warning("NFS server is not available! Crucial functionality likely to be unavailable.")
     else:
         logger.info("NFS server is available!")
+    batcher_thread = threading.Thread(target=batcher, name="batcher", daemon=True)
     try:
+        _pipeline.start(on_done=send_result)
+        batcher_thread.start()
         logger.info(f"{NAME} | 🔄 Starting Kafka consumer...")
-        consumer.consume_messages(serve)
+        consumer.consume_messages(serve, commit=False)
     except Exception as e:
         logger.error(f"{NAME} | ❌ Error in Kafka consumer: {e}")
     finally:
         logger.info(f"{NAME} | 🛑 Stopping Kafka consumer...")
-        consumer.close()  # Закрываем consumer корректно
+        if batcher_thread.is_alive():
+            _incoming.put(None)
+            batcher_thread.join()  # Отдаём пайплайну недособранный батч
+        _pipeline.stop()  # Дожидаемся уже принятых в работу треков
         producer.flush()
+        consumer.close()  # Закрываем после того, как send_result закоммитил их offsets
 
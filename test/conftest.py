@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Service modules live in the repository root, next to test/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+"""
+DemucsProcessor._apply_shifted re-implements demucs.apply.apply_model
+(split=True, shifts=N) chunk by chunk; both must give the same output
+for the same random shifts
+"""
+
+import random
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("demucs")
+
+from demucs.apply import BagOfModels, apply_model
+
+from demucs_processing import DemucsProcessor
+
+SOURCES = ["drums", "bass", "other", "vocals"]
+
+
+class ToyDemucs(torch.nn.Module):
+    """Conv net with the attributes apply_model reads; valid_length pads like HDemucs"""
+
+    def __init__(self, seed, multiple=1):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.samplerate = 100
+        self.segment = 1.0
+        self.audio_channels = 2
+        self.sources = SOURCES
+        self.multiple = multiple
+        self.conv = torch.nn.Conv1d(2, 2 * len(SOURCES), kernel_size=5, padding=2)
+
+    def valid_length(self, length):
+        return -(-length // self.multiple) * self.multiple
+
+    def forward(self, mix):
+        out = self.conv(mix)
+        return out.view(mix.shape[0], len(self.sources), self.audio_channels, -1)
+
+
+def _processor():
+    # Only the chunked loop is exercised: no torchaudio backend or model loading
+    processor = object.__new__(DemucsProcessor)
+    processor._copy_streams = {}
+    return processor
+
+
+def _compare(model, shifts, overlap=0.25, segment=None):
+    mix = torch.randn(2, 2, 537)
+
+    random.seed(shifts)
+    with torch.no_grad():
+        expected = apply_model(model, mix, shifts=shifts, split=True, overlap=overlap,
+                               segment=segment, device="cpu")
+
+    random.seed(shifts)
+    with torch.inference_mode():
+        actual = _processor()._apply_shifted(model, mix, shifts, overlap, segment, "cpu")
+
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("shifts", [0, 1, 3, 7])
+def test_single_model_matches_apply_model(shifts):
+    _compare(ToyDemucs(seed=0).eval(), shifts)
+
+
+@pytest.mark.parametrize("shifts", [0, 1, 3, 7])
+def test_bag_of_models_matches_apply_model(shifts):
+    bag = BagOfModels(
+        [ToyDemucs(seed=0), ToyDemucs(seed=1, multiple=16)],
+        weights=[[1., 0.5, 1., 2.], [0.5, 1., 1., 1.]],
+    ).eval()
+    _compare(bag, shifts, overlap=0.65, segment=0.6)
@@ -0,0 +1,50 @@
+"""
+Array-level checks of the mixer steps the pipeline runs before export
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("soundfile")
+pytest.importorskip("soxr")
+
+from mixer_processing import NumpyMixer
+
+
+def _mixer(vocal, instrumental):
+    # No files: NumpyMixer skips the ffmpeg check, arrays are set directly
+    mixer = NumpyMixer()
+    mixer.vocal_np = vocal
+    mixer.instrumental_np = instrumental
+    return mixer
+
+
+def _noise(frames, scale, seed):
+    return (np.random.default_rng(seed).standard_normal((frames, 2)) * scale).astype(np.float32)
+
+
+@pytest.mark.parametrize("writeable", [True, False])
+def test_normalize_audio_reaches_target_levels(writeable):
+    vocal, instrumental = _noise(44100, 0.3, 0), _noise(44100, 0.05, 1)
+    vocal.flags.writeable = writeable
+    mixer = _mixer(vocal, instrumental)
+
+    mixer.normalize_audio(target_dBFS=-18.0, instrumental_offset=-2.5)
+
+    assert mixer._dbfs(mixer.vocal_np) == pytest.approx(-18.0, abs=1e-3)
+    assert mixer._dbfs(mixer.instrumental_np) == pytest.approx(-20.5, abs=1e-3)
+    assert mixer.vocal_np.dtype == np.float32
+
+
+@pytest.mark.parametrize("vocal_frames, instrumental_frames", [(1000, 1500), (1500, 1000)])
+def test_align_durations_pad_appends_silence(vocal_frames, instrumental_frames):
+    vocal, instrumental = _noise(vocal_frames, 0.3, 0), _noise(instrumental_frames, 0.3, 1)
+    mixer = _mixer(vocal.copy(), instrumental.copy())
+
+    mixer.align_durations(strategy="pad")
+
+    frames = max(vocal_frames, instrumental_frames)
+    for aligned, original in ((mixer.vocal_np, vocal), (mixer.instrumental_np, instrumental)):
+        assert aligned.shape == (frames, 2)
+        assert np.array_equal(aligned[:len(original)], original)
+        assert not aligned[len(original):].any()
@@ -0,0 +1,14 @@
+import torch
+
+
+def resolve_amp_dtype(amp=True):
+    """
+    Autocast dtype for GPU inference: BF16 where supported (Ampere+), FP16 on
+    older Tensor Core GPUs, None (float32) on CPU or when amp is falsy.
+    A torch.dtype passed as amp is used as is
+    """
+    if isinstance(amp, torch.dtype):
+        return amp
+    if not amp or not torch.cuda.is_available():
+        return None
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
@@ -1,4 +1,6 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -10,22 +12,47 @@ def flush(dir_path: str):
         logger.warning(f"[Toolbox] Directory does not exist: {dir_path}")
         return
 
-    removed_files = 0
-    for file in dir_path.rglob("*"):
-        if file.is_file():
-            try:
-                file.unlink()
-                removed_files += 1
-                logger.debug(f"[Toolbox] Removed file: {file}")
-            except Exception as e:
-                logger.warning(f"[Toolbox] Could not delete file {file}: {e}")
+    files, sub_dirs = [], []
+    _scan(str(dir_path), files, sub_dirs)
+
+    # On NFS every unlink is a round-trip, so overlap them
+    with ThreadPoolExecutor(max_workers=32) as ex:
+        removed_files = sum(ex.map(_safe_unlink, files))
+
+    # Drop emptied subdirectories; _scan lists them deepest first
+    for sub_dir in sub_dirs:
+        try:
+            os.rmdir(sub_dir)
+        except OSError as e:
+            logger.debug(f"[Toolbox] Could not remove directory {sub_dir}: {e}")
 
     logger.info(f"[Toolbox] Removed {removed_files} files from: {dir_path}")
 
-def make_name(path:str, suffix: str):
-    path_obj = Path(path)
-    name = path_obj.stem  # "example"
-    ext = path_obj.suffix  # ".txt"
-    name += suffix
-    name += ext
-    return name
+
+def _scan(path: str, files: list, dirs: list):
+    """
+    Collects everything under path. scandir entries carry the type from
+    getdents, so telling files from directories needs no extra stat per entry
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _scan(entry.path, files, dirs)
+                dirs.append(entry.path)
+            else:
+                files.append(entry.path)
+
+
+def _safe_unlink(file: str) -> bool:
+    try:
+        os.unlink(file)
+        logger.debug(f"[Toolbox] Removed file: {file}")
+        return True
+    except Exception as e:
+        logger.warning(f"[Toolbox] Could not delete file {file}: {e}")
+        return False
+
+
+def derive(base: Path, work_dir: Path, suffix: str) -> Path:
+    """Path in work_dir named after base with suffix before the extension: a.wav -> work_dir/a-suffix.wav"""
+    return work_dir / f"{base.stem}{suffix}{base.suffix}"
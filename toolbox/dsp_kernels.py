@@ -0,0 +1,21 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def subtract_noise(S, noise, prop, out):
+    """Fused |S| -> subtract noise -> clip at 0 -> rescale S, one pass over the STFT"""
+    for k in prange(S.shape[0]):
+        floor = prop * noise[k]
+        for t in range(S.shape[1]):
+            m = abs(S[k, t])
+            new = max(m - floor, 0.0)
+            out[k, t] = S[k, t] * (new / (m + 1e-12))
+
+
+def spectral_subtract(S, noise, prop):
+    S = np.ascontiguousarray(S, dtype=np.complex64)
+    noise = np.ascontiguousarray(noise, dtype=np.float32)
+    out = np.empty_like(S)
+    subtract_noise(S, noise, np.float32(prop), out)
+    return out